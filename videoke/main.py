@@ -1,16 +1,27 @@
 #!/usr/bin/env python3
 
+import argparse
 import configparser
+import functools
 import logging
 import os.path
+import queue
 import random
 import sys
+import threading
 import time
 
 import ffpyplayer.player as ff
 os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"  # silence ad
 import pygame
 
+try:
+    # Pillow-SIMD is a drop-in Pillow fork with vectorized resampling
+    import PIL
+    import PIL.Image
+    PILLOW_SIMD = '.post' in PIL.__version__
+except ImportError:
+    PILLOW_SIMD = False
 
 SLUG = __package__
 
@@ -19,12 +30,26 @@ log = logging.getLogger(__name__)
 _current_background = None
 _last_music = None
 
+# Positions of the above in their caches, to pick a different one next time
+_current_background_index = None
+_last_music_index = None
+
+# Directory listing caches, refreshed only when scanned directories change
+_music_cache = []
+_music_cache_key = None
+_bg_cache = []
+_bg_cache_key = None
+
 # Platform-dependent!
 CONFIG = os.path.expanduser(os.path.join(os.environ.get('XDG_CONFIG_HOME', '~/.config'),
                                          SLUG, '{0}.ini'.format(SLUG)))
 USERDATA = os.path.expanduser(os.path.join(os.environ.get('XDG_DATA_HOME', '~/.local/share'),
                                            SLUG))
 
+# Lowercase filename suffixes, as matched by str.endswith()
+MUSIC_SUFFIXES = ('.mp4',)
+IMAGE_SUFFIXES = ('.bmp', '.jpg', '.jpeg', '.png')
+
 class COLORS:
     WHITE   = pygame.colordict.THECOLORS['white']
     MAGENTA = pygame.colordict.THECOLORS['magenta']
@@ -34,11 +59,13 @@ class OPTIONS:
     FULLSCREEN = False
     LOGLEVEL = logging.INFO
     DEBUG = False
-    SCREEN_SIZE = (1600, 900)  # Fullscreen ignores this and use desktop resolution
+    SCREEN_SIZE = (1600, 900)  # Fullscreen ignores this and use FULLSCREEN_SIZE
+    FULLSCREEN_SIZE = (1280, 720)  # Rendering size, hardware-scaled to desktop resolution
     FPS = 60  # 0 for Unbounded FPS
     BG_COLOR = COLORS.BLACK  # Background color (Magenta)
     CAPTION = "Videokê RES"
     DATADIR = os.path.join(os.path.dirname(__file__), 'data')
+    ICON = os.path.join(DATADIR, '..', '..', '{0}.png'.format(SLUG))
     CONFIG = CONFIG
     MUSICDIR = os.path.join(DATADIR, 'music')
 
@@ -75,9 +102,15 @@ def scale_size(original, size=(), proportional=True, multiple=(1, 1)):
     if not proportional:
         return round_to_multiple(size, multiple)
 
-    rect = pygame.Rect((0,0), original)
-    result = rect.fit(pygame.Rect((0,0), size))
-    return round_to_multiple((result.width, result.height), multiple)
+    # Same as pygame.Rect.fit(), without the Rect overhead
+    (ow, oh), (sw, sh) = original, size
+    if not (ow and oh):
+        return round_to_multiple(original, multiple)
+    if sw * oh <= sh * ow:
+        result = (sw, oh * sw // ow)
+    else:
+        result = (ow * sh // oh, sh)
+    return round_to_multiple(result, multiple)
 
 
 def resize(image, size=(), proportional=True, colorkey=None):
@@ -90,26 +123,71 @@ def resize(image, size=(), proportional=True, colorkey=None):
     See scale_size() for documentation on <size> and <proportional>.
 
     For regular images, requesting a <size> different than the original (after processing
-    aspect and roundings) will use pygame.transform.smoothscale().
+    aspect and roundings) will use smoothscale().
+
+    As a fast path, an image already at <size> and without <colorkey> is returned as-is,
+    unconverted.
     """
-    if colorkey is None:
-        image = image.convert_alpha()
-    else:
-        # If colorkey
-        if len(colorkey) == 2:
-            colorkey = image.get_at(colorkey)
-        image.set_colorkey(colorkey)
-        image = image.convert()
+    if colorkey is None and image.get_size() == size:
+        return image
 
+    image = _prepare(image, colorkey)
     size = scale_size(image.get_size(), size, proportional)
     if size == image.get_size():
         return image
 
+    return _resize_raw(image, size)
+
+
+def _prepare(image, colorkey=None):
+    """Return <image> converted to display format. See resize() for <colorkey>"""
+    if colorkey is None:
+        return image.convert_alpha()
+
+    # If colorkey
+    if len(colorkey) == 2:
+        colorkey = image.get_at(colorkey)
+    image.set_colorkey(colorkey)
+    return image.convert()
+
+
+def _resize_raw(image, size, dest=None):
+    """Return <image> scaled to exactly <size>, without any prior conversion
+
+    See smoothscale() for <dest>.
+    """
     # transform.smoothscale() requires a 24 or 32-bit image, so...
     if image.get_bitsize() not in (24, 32):
         image = image.convert_alpha()
 
-    return pygame.transform.smoothscale(image, size)
+    return smoothscale(image, size, dest)
+
+
+def smoothscale(image, size, dest=None):
+    """Wrapper for pygame.transform.smoothscale, using Pillow-SIMD if available
+
+    <dest>, if given, is a Surface with <size> and <image>'s format to render into,
+    saving the allocation of a new one. Pillow-SIMD ignores it.
+    """
+    if not PILLOW_SIMD:
+        if dest is None:
+            return pygame.transform.smoothscale(image, size)
+        return pygame.transform.smoothscale(image, size, dest)
+
+    mode = 'RGBA' if image.get_flags() & pygame.SRCALPHA else 'RGB'
+    data = resize_buffer(pygame.image.tostring(image, mode), image.get_size(), size, mode)
+    result = pygame.image.frombuffer(data, size, mode)
+    result.set_colorkey(image.get_colorkey())
+    return result
+
+
+def resize_buffer(data, original, size, mode='RGB'):
+    """Resize raw pixel <data> from <original> to <size> using Pillow-SIMD
+
+    <mode> is a PIL raw mode, such as 'RGB' or 'RGBA'. Return the resized bytes.
+    """
+    image = PIL.Image.frombuffer(mode, original, data, 'raw', mode, 0, 1)
+    return image.resize(size, PIL.Image.BILINEAR).tobytes()
 
 
 def load_image(path, size=(), proportional=True):
@@ -117,59 +195,119 @@ def load_image(path, size=(), proportional=True):
     return resize(pygame.image.load(path), size, proportional)
 
 
+@functools.lru_cache(maxsize=16)
+def _load_background(path, size, color):
+    """Return a <size> screen of the image <path> centered over <color>
+
+    Result is opaque and in display format, so it's a plain copy to the screen.
+    """
+    background = pygame.Surface(size)
+    background.fill(color)
+    centerblit(load_image(path, size), background)
+    return background.convert()
+
+
+def _scandir(path, suffixes):
+    """Return a list of os.DirEntry of files in <path> ending with any of <suffixes>
+
+    <suffixes> is a tuple of lowercase extensions with leading dot, such as ('.mp4',).
+    Missing or unreadable directories yield an empty list.
+    """
+    try:
+        with os.scandir(path) as it:
+            return [entry for entry in it
+                    if entry.name.lower().endswith(suffixes) and entry.is_file()]
+    except OSError:
+        return []
+
+
+def _cache_key(dirs):
+    """Return a hashable key of <dirs> and their mtimes, for cache invalidation"""
+    key = []
+    for path in dirs:
+        try:
+            key.append((path, os.stat(path).st_mtime_ns))
+        except OSError:
+            key.append((path, None))
+    return tuple(key)
+
+
+def _random_index(size, last=None):
+    """Return a random index in range(<size>) other than <last>, if possible"""
+    if last is None or size == 1:
+        return random.randrange(size)
+    # Pick among all but the last position, then shift over the skipped one
+    index = random.randrange(size - 1)
+    return index + (index >= last)
+
+
+def _find(pool, item):
+    """Return the index of <item> in <pool>, or None if not found"""
+    try:
+        return pool.index(item)
+    except ValueError:
+        return None
+
+
 def random_music():
-    global _last_music
-
-    music = {}
-    for mdir in (
-            os.path.join(OPTIONS.DATADIR, 'music'),
-            os.path.join(USERDATA, 'music'),
-            OPTIONS.MUSICDIR,
-    ):
-        music.update({f: os.path.join(mdir, f)
-                      for f in (os.listdir(mdir) if os.path.isdir(mdir) else [])
-                      if extension(f) == 'mp4'})
-    log.debug("%d music found", len(music))
-    if not music:
+    global _last_music, _last_music_index, _music_cache_key
+
+    dirs = (
+        os.path.join(OPTIONS.DATADIR, 'music'),
+        os.path.join(USERDATA, 'music'),
+        OPTIONS.MUSICDIR,
+    )
+    key = _cache_key(dirs)
+    if key != _music_cache_key:
+        # Deduplicate by filename, the last directory taking precedence
+        paths = []
+        names = set()
+        for mdir in reversed(dirs):
+            for entry in _scandir(mdir, MUSIC_SUFFIXES):
+                if entry.name not in names:
+                    names.add(entry.name)
+                    paths.append(entry.path)
+        _music_cache[:] = paths
+        _music_cache_key = key
+        _last_music_index = _find(_music_cache, _last_music)
+        log.debug("%d music found", len(_music_cache))
+    if not _music_cache:
         raise FileNotFoundError("No music found!")
 
-    if len(music) == 1:
-        video = tuple(music.keys())[0]
-    else:
-        while True:
-            video = random.choice(tuple(music.keys()))
-            if video != _last_music:
-                break
-    _last_music = music[video]
+    _last_music_index = _random_index(len(_music_cache), _last_music_index)
+    _last_music = _music_cache[_last_music_index]
     return _last_music
 
 
 def random_background(surface):
-    global _current_background
+    global _current_background, _current_background_index, _bg_cache_key
     bgdir = os.path.join(OPTIONS.DATADIR, 'backgrounds')
-    bgs = tuple(os.path.join(bgdir, f)
-                for f in os.listdir(bgdir)
-                if extension(f) in ('bmp', 'jpg', 'jpeg', 'png'))
-    if not bgs:
+    key = _cache_key((bgdir,))
+    if key != _bg_cache_key:
+        _bg_cache[:] = (entry.path for entry in _scandir(bgdir, IMAGE_SUFFIXES))
+        _bg_cache_key = key
+        _current_background_index = _find(_bg_cache, _current_background)
+    if not _bg_cache:
         return
 
-    if len(bgs) == 1:
-        bg = bgs[0]
-    else:
-        while True:
-            bg = random.choice(bgs)
-            if bg != _current_background:
-                break
+    _current_background_index = _random_index(len(_bg_cache),
+                                              _current_background_index)
+    bg = _bg_cache[_current_background_index]
 
-    surface.fill(OPTIONS.BG_COLOR)
-    centerblit(load_image(bg, surface.get_size()), surface)
+    surface.blit(_load_background(bg, surface.get_size(), tuple(OPTIONS.BG_COLOR)), (0, 0))
     _current_background = bg
 
 
 def centerblit(surface, dest):
-    w, h = dest.get_size()
-    x, y = surface.get_size()
-    dest.blit(surface, ((w//2)-(x//2), (h//2)-(y//2)))
+    """Blit <surface> centered on <dest>, returning the affected rect"""
+    return dest.blit(surface, center_position(surface.get_size(), dest.get_size()))
+
+
+def center_position(size, dest_size):
+    """Return the top-left position to center a <size> area in <dest_size>"""
+    w, h = dest_size
+    x, y = size
+    return (w//2)-(x//2), (h//2)-(y//2)
 
 
 class VideoPlayer:
@@ -179,88 +317,188 @@ class VideoPlayer:
     }
 
     def __init__(self, path, surface):
-        self.player = ff.MediaPlayer(path)
+        # Let ffmpeg's swscale output frames already in display format and size
+        self.player = ff.MediaPlayer(path, ff_opts={'out_fmt': 'rgb24'})
         self.surface = surface
-        self.image = None
-        self.wait = 0
+        self.surface_size = surface.get_size()  # Display does not change size
+        self.dest_rect = None  # Where frames are blit on surface, once known
+        self.frame_size = None  # Frame size that fits display, as decoded or pre-scaled
+        self.frame = None  # Scheduled (image, buffer owner, monotonic display ns)
+        self.buffers = []  # Scratch surfaces for resizing frames, see buffer()
         self.finished = False
 
+        # Frames are decoded and converted by a worker thread, so that work
+        # overlaps with display. A None frame signals the end of the video.
+        self.frames = queue.Queue(maxsize=2)
+        self._stopping = threading.Event()
+        self.thread = threading.Thread(target=self._decode, name="VideoDecoder",
+                                       daemon=True)
+        self.thread.start()
+
     @property
     def has_finished(self):
         return self.finished
 
     def play(self):
-        """Display a frame image if needed, and return True if so."""
+        """Display a frame image if needed, and return its screen rect if so."""
 
         # No player, no play
         if not self.player:
             return
 
-        # Got any scheduled frame image to display?
-        if self.image:
-            # Is it too early to display it?
-            if time.time() < self.wait:
+        # Get the next frame image, if none is scheduled yet
+        if self.frame is None:
+            try:
+                self.frame = self.frames.get_nowait()
+            except queue.Empty:
                 return
-        else:
-            # Get the next frame image
-            frame, val = self.player.get_frame()
 
             # Has video ended?
-            if val == 'eof':
+            if self.frame is None:
                 self.stop()
                 return
 
-            # Is frame empty?
-            if frame is None:
-                return
-
-            # Save image
-            self.image = frame[0]
+        # Is it too early to display it?
+        image, _, wait = self.frame
+        if time.monotonic_ns() < wait:
+            return
 
-            # Do we need to wait / schedule before display?
-            if val > 0:
-                self.wait = time.time() + val
-                return
+        # Display it, clear schedule and report where image was displayed
+        size = image.get_size()
+        if self.dest_rect is None or self.dest_rect.size != size:
+            self.dest_rect = pygame.Rect(center_position(size, self.surface_size), size)
+        rect = self.surface.blit(image, self.dest_rect)
+        self.frame = None
+        return rect
 
-        # Display it
+    def _decode(self):
+        """Worker thread loop, queueing converted frames until video ends"""
         try:
-            image = pygame.image.frombuffer(
-                self.image.to_bytearray()[0],
-                self.image.get_size(),
-                self._fmt_map.get(self.image.get_pixel_format(), None)
-            )
-            centerblit(resize(image, self.surface.get_size()), self.surface)
+            while not self._stopping.is_set():
+                frame, val = self.player.get_frame()
+
+                # Has video ended?
+                if val == 'eof':
+                    break
+
+                # Is frame empty?
+                if frame is None:
+                    time.sleep(0.01)
+                    continue
+
+                # Convert it while waiting for its display time, and only then
+                # get the next one, as ffpyplayer schedules frames as if each one
+                # had been displayed when the next is requested.
+                wait = time.monotonic_ns() + int(val * 1e9)
+                image = frame[0]
+                self._put((self.convert(image), image, wait))
+                self._stopping.wait((wait - time.monotonic_ns()) / 1e9)
         except Exception as e:
             log.error(e)
-            self.stop()
-            return
+        self._put(None)
 
-        # Clear schedule and report that image was displayed
-        self.image = None
-        return True
+    def _put(self, item):
+        """Queue <item>, giving up if player is stopped meanwhile"""
+        while not self._stopping.is_set():
+            try:
+                self.frames.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def convert(self, frame):
+        """Return a Surface from ffpyplayer image <frame>, fit to display size
+
+        The Surface may share <frame>'s buffer, so it is only valid while <frame>
+        is alive.
+        """
+        # A view of ffmpeg's own frame buffer, no copy involved
+        data = frame.to_memoryview()[0]
+        fmt = self._fmt_map.get(frame.get_pixel_format(), None)
+        original = frame.get_size()
+
+        # Fast path, frame already fits the display
+        if original == self.frame_size:
+            return pygame.image.frombuffer(data, original, fmt)
+
+        size = scale_size(original, self.surface_size)
+        if size == original:
+            self.frame_size = size
+            return pygame.image.frombuffer(data, size, fmt)
+        if size != self.frame_size:
+            # Following frames will arrive pre-scaled, resize only until then
+            self.set_frame_size(size)
+        if PILLOW_SIMD:
+            # Resize the raw frame directly, skipping a Surface round-trip
+            return pygame.image.frombuffer(
+                resize_buffer(data, original, size, fmt), size, fmt)
+        # Raw RGB frames need no conversion prior to scaling
+        image = pygame.image.frombuffer(data, original, fmt)
+        return _resize_raw(image, size, self.buffer(image, size))
+
+    def buffer(self, image, size):
+        """Return a scratch Surface to resize <image> into <size>
+
+        Buffers are recycled in turn, enough of them so none is reused while its
+        frame is still queued or being displayed.
+        """
+        if not self.buffers or self.buffers[0].get_size() != size:
+            self.buffers = [pygame.Surface(size, 0, image)
+                            for _ in range(self.frames.maxsize + 2)]
+        self.buffers.append(self.buffers.pop(0))
+        return self.buffers[-1]
+
+    def set_frame_size(self, size):
+        """Request ffmpeg to scale decoded frames to <size>"""
+        try:
+            self.player.set_size(*size)
+        except Exception as e:
+            # ffpyplayer compiled without avfilter can't scale, so resize() it is
+            log.warning("Could not set video frame size: %s", e)
+        self.frame_size = size
 
     def stop(self):
         if self.player:
+            self._stopping.set()
+            self.thread.join()
             self.player.close_player()
             self.player = None
         self.surface = None
-        self.image = None
-        self.wait = 0
+        self.frame = None
+        self.buffers = []
         self.finished = True
 
 
+def parse_args(argv=None):
+    """Parse command-line arguments, ignoring unknown ones"""
+    parser = argparse.ArgumentParser(prog=SLUG, description=OPTIONS.CAPTION)
+    parser.add_argument('-f', '--fullscreen', action='store_true',
+                        help="Run in fullscreen mode")
+    parser.add_argument('-q', '--quiet', dest='loglevel', action='store_const',
+                        const=logging.WARNING, default=OPTIONS.LOGLEVEL,
+                        help="Suppress informative messages")
+    parser.add_argument('-d', '--debug', '-v', '--verbose', dest='loglevel',
+                        action='store_const', const=logging.DEBUG,
+                        help="Print debugging messages")
+    parser.add_argument('-F', '--fps', '--FPS', type=int, default=OPTIONS.FPS,
+                        help="Frames per second, 0 for unbounded. [Default: %(default)s]")
+    parser.add_argument('-c', '--config', default=OPTIONS.CONFIG,
+                        help="Configuration file. [Default: %(default)s]")
+    parser.add_argument('-m', '--music', '--music-dir', metavar='DIR',
+                        help="Music directory, overriding the one in config")
+    return parser.parse_known_args(argv)[0]
+
+
 def main(argv=None):
     """ Main Program"""
     if argv is None:
         argv = sys.argv[1:]
 
-    # Soon to be replaced by a proper argparse
-    for i, arg in enumerate(argv):
-        if   arg in ('-f', "--fullscreen"):               OPTIONS.FULLSCREEN = True
-        elif arg in ('-q', "--quiet"):                    OPTIONS.LOGLEVEL = logging.WARNING
-        elif arg in ('-d', "--debug", '-v', "--verbose"): OPTIONS.LOGLEVEL = logging.DEBUG
-        elif arg in ('-F', "--fps", "--FPS"):             OPTIONS.FPS = int(argv[i+1])
-        elif arg in ('-c', "--config"):                   OPTIONS.CONFIG = argv[i+1]
+    args = parse_args(argv)
+    OPTIONS.FULLSCREEN = args.fullscreen or OPTIONS.FULLSCREEN
+    OPTIONS.LOGLEVEL = args.loglevel
+    OPTIONS.FPS = args.fps
+    OPTIONS.CONFIG = args.config
     OPTIONS.DEBUG = OPTIONS.LOGLEVEL == logging.DEBUG
 
     logging.basicConfig(level=OPTIONS.LOGLEVEL, format='%(levelname)s: %(message)s')
@@ -274,35 +512,47 @@ def main(argv=None):
             OPTIONS.MUSICDIR = os.path.expanduser(cp.get(SLUG, 'music'))
         except configparser.NoOptionError as e:
             log.warning("%s in %s", e, OPTIONS.CONFIG)
-    for i, arg in enumerate(argv):
-        if arg in ('-m', "--music", "--music-dir"):
-            OPTIONS.MUSICDIR = argv[i+1]
+    if args.music:
+        OPTIONS.MUSICDIR = args.music
     log.info('Reading music from: %s', OPTIONS.MUSICDIR)
 
     os.environ['SDL_VIDEO_CENTERED'] = '1'
     pygame.display.init()
 
+    # Let SDL discard all events but the handled ones, before they reach Python
+    events = (pygame.QUIT, pygame.KEYUP, pygame.MOUSEBUTTONUP)
+    pygame.event.set_blocked(None)
+    pygame.event.set_allowed(events)
+
     # Set caption and icon
     pygame.display.set_caption(OPTIONS.CAPTION)
-    pygame.display.set_icon(pygame.image.load("{0}.png".format(SLUG)))
+    pygame.display.set_icon(pygame.image.load(OPTIONS.ICON))
 
     # Set the screen
     flags = 0
     size = OPTIONS.SCREEN_SIZE
     if OPTIONS.FULLSCREEN:
-        flags |= pygame.FULLSCREEN | pygame.HWSURFACE | pygame.DOUBLEBUF
-        size = (0, 0)  # current desktop resolution
-    screen = pygame.display.set_mode(size, flags)
+        # SCALED renders via the GPU, upscaling to current desktop resolution
+        flags |= pygame.FULLSCREEN | pygame.HWSURFACE | pygame.DOUBLEBUF | pygame.SCALED
+        size = OPTIONS.FULLSCREEN_SIZE
+        try:
+            screen = pygame.display.set_mode(size, flags, vsync=1)
+        except pygame.error as e:
+            log.warning("Could not enable vsync: %s", e)
+            screen = pygame.display.set_mode(size, flags)
+    else:
+        screen = pygame.display.set_mode(size, flags)
 
     # Set the background
     random_background(screen)
 
     clock = pygame.time.Clock()
     done = False
-    dirty = True
+    dirty = True  # Whole screen needs updating
     player = None
     while not done:
-        for event in pygame.event.get():
+        change_background = False
+        for event in pygame.event.get(events):
             if   ((event.type in (pygame.QUIT,)) or
                   (event.type == pygame.MOUSEBUTTONUP and event.button == pygame.BUTTON_RIGHT) or
                   (event.type == pygame.KEYUP and event.key == pygame.K_ESCAPE)):
@@ -310,8 +560,7 @@ def main(argv=None):
 
             elif ((event.type == pygame.MOUSEBUTTONUP and event.button == pygame.BUTTON_LEFT) or
                   (event.type == pygame.KEYUP and event.key == pygame.K_SPACE)):
-                random_background(screen)
-                dirty = True
+                change_background = True
 
             elif ((event.type == pygame.KEYUP and event.key == pygame.K_RETURN)):
                 if player:
@@ -324,19 +573,29 @@ def main(argv=None):
                     except FileNotFoundError as e:
                         log.error(e)
 
+        # Change background at most once, no matter how many requests
+        if change_background:
+            random_background(screen)
+            dirty = True
+
+        rect = None  # Screen area updated by the player
         if player:
             if player.finished:
                 player = None
                 random_background(screen)
                 dirty = True
             else:
-                dirty = player.play()
+                rect = player.play()
 
         if dirty:
-            pygame.display.update()
+            pygame.display.flip()
             dirty = False
+        elif rect:
+            pygame.display.update(rect)
         clock.tick(OPTIONS.FPS)
 
+    if player:
+        player.stop()
     pygame.quit()
 
 